@@ -1,9 +1,38 @@
+import asyncio
+import functools
+import html
+import json
 import logging
 import os
+import re
+import sqlite3
+import threading
 import time
-from dataclasses import dataclass, field
-from datetime import date
-from typing import Dict, Optional, Tuple, List
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field, fields
+from datetime import date, datetime, timedelta
+from typing import Awaitable, Callable, Dict, FrozenSet, NamedTuple, Optional, Set, Tuple, List
+from urllib.parse import urlsplit
+
+try:
+    import ahocorasick  # optional: pyahocorasick, single-pass banned-word matching
+except ImportError:  # fall back to per-word substring checks
+    ahocorasick = None
+
+try:
+    import hyperscan  # optional: python-hyperscan (x86 only), SIMD banned-word matching
+except ImportError:
+    hyperscan = None
+
+try:
+    import orjson  # optional: faster JSON for the stored chat configs
+except ImportError:
+    orjson = None
+
+try:
+    import uvloop  # optional: faster event loop (not available on Windows)
+except ImportError:
+    uvloop = None
 
 from telegram import (
     Update,
@@ -11,14 +40,21 @@ from telegram import (
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     ChatPermissions,
+    MessageEntity,
 )
+from telegram.constants import MessageLimit
+from telegram.error import BadRequest
+from telegram.request import HTTPXRequest
 from telegram.ext import (
+    AIORateLimiter,
     ApplicationBuilder,
+    ApplicationHandlerStop,
     ContextTypes,
     ChatJoinRequestHandler,
-    CommandHandler,
+    ChatMemberHandler,
     MessageHandler,
     CallbackQueryHandler,
+    TypeHandler,
     filters,
 )
 
@@ -32,21 +68,76 @@ logger = logging.getLogger("OmniGate")
 # ---------------- Env vars ----------------
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID_ENV = os.getenv("ADMIN_ID")  # owner/global admin (optional but recommended)
-
-
-def get_admin_id() -> Optional[int]:
-    if not ADMIN_ID_ENV:
+STATE_DB = os.getenv("STATE_DB", "omnigate.db")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # public HTTPS URL; enables webhook mode when set
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# Fallback switch: keep WEBHOOK_URL configured but receive updates by long polling
+FORCE_POLLING = os.getenv("FORCE_POLLING", "").lower() in ("1", "true", "yes")
+PORT = int(os.getenv("PORT", "8443"))
+# Self-hosted telegram-bot-api server, e.g. http://127.0.0.1:8081
+BOT_API_URL = os.getenv("BOT_API_URL", "").rstrip("/")
+STATE_FLUSH_SECONDS = 1
+
+
+def _parse_admin_id(raw: Optional[str]) -> Optional[int]:
+    if not raw:
         return None
     try:
-        return int(ADMIN_ID_ENV)
+        return int(raw)
     except ValueError:
         logger.warning("ADMIN_ID is not a valid integer.")
         return None
 
 
+# Parsed once; the env var does not change while the process runs.
+ADMIN_ID: Optional[int] = _parse_admin_id(ADMIN_ID_ENV)
+
+
+# ---------------- Permission presets ----------------
+
+def _send_permissions(allowed: bool) -> ChatPermissions:
+    return ChatPermissions(
+        can_send_messages=allowed,
+        can_send_audios=allowed,
+        can_send_documents=allowed,
+        can_send_photos=allowed,
+        can_send_videos=allowed,
+        can_send_video_notes=allowed,
+        can_send_voice_notes=allowed,
+        can_send_other_messages=allowed,
+        can_add_web_page_previews=allowed,
+    )
+
+
+# ChatPermissions is immutable, so one instance of each preset is shared
+_MUTED_PERMS = _send_permissions(False)
+_UNMUTED_PERMS = _send_permissions(True)
+
+
 # ---------------- In-memory state ----------------
 
-@dataclass
+# Today's date as an ordinal, refreshed only once the next local midnight passes
+_today_ordinal: int = 0
+_today_expires_at: float = 0.0
+
+
+def _get_today() -> int:
+    global _today_ordinal, _today_expires_at
+    now = time.time()
+    if now >= _today_expires_at:
+        today = date.today()
+        tomorrow = datetime.combine(today + timedelta(days=1), datetime.min.time())
+        _today_ordinal = today.toordinal()
+        _today_expires_at = tomorrow.timestamp()
+    return _today_ordinal
+
+
+# Join modes in the order the settings button cycles through them
+_NEXT_MODE = {"AUTO": "FILTERED", "FILTERED": "OFF", "OFF": "AUTO"}
+_VALID_MODES = frozenset(_NEXT_MODE)
+
+
+@dataclass(slots=True)
 class ChatConfig:
     # Join logic
     mode: str = "AUTO"  # AUTO, FILTERED, OFF
@@ -57,6 +148,11 @@ class ChatConfig:
     # Moderation
     block_links: bool = False
     banned_words: List[str] = field(default_factory=list)
+    # Compiled from banned_words on first use, once per loaded config
+    # (nothing edits banned_words at runtime; an editor must reset this to None)
+    _banned_matcher: Optional[Callable[[str], Optional[str]]] = field(
+        default=None, init=False, repr=False, compare=False
+    )
 
     # Warnings
     warnings_enabled: bool = True
@@ -79,74 +175,390 @@ class ChatConfig:
     # Strict mode (manual toggle)
     strict_mode_enabled: bool = False
 
+    # "group" / "channel" / "chat"; filled in the first time the chat object is seen
+    type_label: str = ""
+
     # Stats
     approved_total: int = 0
     declined_total: int = 0
     approved_today: int = 0
     declined_today: int = 0
-    last_stats_date: date = field(default_factory=date.today)
+    last_stats_day: int = field(default_factory=_get_today)  # date.toordinal()
+
+
+GROUP_CHAT_TYPES = frozenset({"group", "supergroup"})
+ADMIN_STATUSES = frozenset({"administrator", "creator"})
 
+# chat_id -> ChatConfig, least recently used first
+MAX_CHAT_CONFIGS = 50_000
+chat_configs: "OrderedDict[int, ChatConfig]" = OrderedDict()
+
+
+class ChatInfo(NamedTuple):
+    title: str
+    type: str
 
-# chat_id -> ChatConfig
-chat_configs: Dict[int, ChatConfig] = {}
 
 # Known chats for /mychats
-known_chats: Dict[int, Dict[str, str]] = {}  # chat_id -> {"title": ..., "type": ...}
+known_chats: Dict[int, ChatInfo] = {}  # chat_id -> ChatInfo
+
+
+class ExpiringDict:
+    """Mapping with a size cap whose entries expire `ttl` seconds after their last write.
+
+    Entries are kept in write order, so both expired and surplus entries are
+    evicted from the front in O(1) each.
+    """
+
+    __slots__ = ("maxsize", "ttl", "_data")
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[object, Tuple[float, object]]" = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None or item[0] <= time.monotonic():
+            return default
+        return item[1]
+
+    def __setitem__(self, key, value) -> None:
+        data = self._data
+        now = time.monotonic()
+        data.pop(key, None)
+        data[key] = (now + self.ttl, value)
+        while data:
+            oldest_expiry = next(iter(data.values()))[0]
+            if oldest_expiry > now and len(data) <= self.maxsize:
+                break
+            data.popitem(last=False)
+
 
-# Per-user warnings (chat_id, user_id) -> warning_count
-user_warnings: Dict[Tuple[int, int], int] = {}
+# Per-user warnings (chat_id, user_id) -> warning_count; forgotten a day after the last warning
+user_warnings = ExpiringDict(maxsize=100_000, ttl=86_400)
 
-# Flood tracking (chat_id, user_id) -> list[timestamps]
-flood_activity: Dict[Tuple[int, int], List[float]] = {}
+# Flood tracking (chat_id, user_id) -> recent timestamps, at most flood_max_msgs + 1.
+# Idle senders drop out once their bucket is older than any sensible flood window.
+flood_activity = ExpiringDict(maxsize=50_000, ttl=300)
 
-# Pending verification for safe welcome (chat_id, user_id) -> bool
+# Pending verification for safe welcome (chat_id, user_id) -> bool.
+# Not size-capped: dropping an entry would leave that member muted for good.
+# Each entry has a timer that removes it (and the member) after
+# VERIFY_TIMEOUT_SECONDS, which is what bounds this dict.
+VERIFY_TIMEOUT_SECONDS = 600
 pending_verification: Dict[Tuple[int, int], bool] = {}
+_verification_timers: Dict[Tuple[int, int], asyncio.TimerHandle] = {}
 
+# Chat admin caches, keyed by chat_id -> (fetched_at monotonic, value)
+ADMIN_CACHE_TTL = 300
+ADMIN_CACHE_MAX_CHATS = 10_000
+_admin_cache: Dict[int, Tuple[float, FrozenSet[int]]] = {}
+_bot_admin_cache: Dict[int, Tuple[float, bool]] = {}
 
-def get_chat_config(chat_id: int) -> ChatConfig:
+
+def get_chat_config(chat_id: int, chat=None) -> ChatConfig:
     cfg = chat_configs.get(chat_id)
     if cfg is None:
-        cfg = ChatConfig()
-        chat_configs[chat_id] = cfg
+        cfg = chat_configs[chat_id] = _load_chat_config(chat_id)
+        if len(chat_configs) > MAX_CHAT_CONFIGS:
+            _evict_chat_config()
+    else:
+        chat_configs.move_to_end(chat_id)
+    if not cfg.type_label and chat is not None:
+        cfg.type_label = chat_type_label(chat)
     # reset daily counters if date changed
-    today = date.today()
-    if cfg.last_stats_date != today:
-        cfg.last_stats_date = today
+    today = _get_today()
+    if cfg.last_stats_day != today:
+        cfg.last_stats_day = today
         cfg.approved_today = 0
         cfg.declined_today = 0
     return cfg
 
 
-def remember_chat(chat) -> None:
+# ---------------- Persistence ----------------
+#
+# Chat configs and known chats live in SQLite (WAL mode). Configs are read
+# lazily on a cache miss in get_chat_config; changes are only marked dirty and
+# written in batches by a background task every STATE_FLUSH_SECONDS.
+
+_CONFIG_FIELDS = tuple(f.name for f in fields(ChatConfig) if f.init)
+
+_db: Optional[sqlite3.Connection] = None
+_db_lock = threading.Lock()  # connection is shared with the flush worker thread
+# Separate connection for lazy loads on the event loop. WAL lets it read
+# while a flush holds _db for its write transaction.
+_read_db: Optional[sqlite3.Connection] = None
+
+_dirty_configs: Set[int] = set()
+_dirty_known_chats: Set[int] = set()
+# Dirty configs pushed out of the LRU before the next flush wrote them
+_evicted_configs: Dict[int, ChatConfig] = {}
+# Configs a flush is writing right now. Until that commits, _read_db still
+# sees the old row, so lazy loads must be served from here.
+_flushing: Dict[int, ChatConfig] = {}
+
+
+def open_state_db() -> None:
+    """Open (creating if needed) the state database and load known chats."""
+    global _db, _read_db
+    _db = sqlite3.connect(STATE_DB, check_same_thread=False)
+    with _db_lock:
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("PRAGMA synchronous=NORMAL")
+        _db.execute(
+            "CREATE TABLE IF NOT EXISTS chat_configs "
+            "(chat_id INTEGER PRIMARY KEY, data TEXT NOT NULL)"
+        )
+        _db.execute(
+            "CREATE TABLE IF NOT EXISTS known_chats "
+            "(chat_id INTEGER PRIMARY KEY, title TEXT NOT NULL, type TEXT NOT NULL)"
+        )
+        _db.commit()
+        rows = _db.execute("SELECT chat_id, title, type FROM known_chats").fetchall()
+    _read_db = sqlite3.connect(STATE_DB)
+    _read_db.execute("PRAGMA query_only=ON")
+    for chat_id, title, chat_type in rows:
+        known_chats[chat_id] = ChatInfo(title, chat_type)
+    logger.info("Opened state database %s (%d known chats)", STATE_DB, len(rows))
+
+
+def close_state_db() -> None:
+    global _db, _read_db
+    if _read_db is not None:
+        _read_db.close()
+        _read_db = None
+    if _db is not None:
+        with _db_lock:
+            _db.close()
+        _db = None
+
+
+def mark_state_dirty(chat_id: int) -> None:
+    """Flag a chat's config as changed so the next flush writes it."""
+    _dirty_configs.add(chat_id)
+
+
+def _config_to_json(cfg: ChatConfig) -> str:
+    values = {name: getattr(cfg, name) for name in _CONFIG_FIELDS}
+    if orjson is not None:
+        return orjson.dumps(values).decode()
+    return json.dumps(values, ensure_ascii=False)
+
+
+_json_loads = orjson.loads if orjson is not None else json.loads
+
+
+def _config_from_json(chat_id: int, raw: str) -> ChatConfig:
+    try:
+        values = {k: v for k, v in _json_loads(raw).items() if k in _CONFIG_FIELDS}
+        if values.get("mode", "AUTO") not in _VALID_MODES:
+            logger.warning("Ignoring unknown mode %r for chat %s", values.pop("mode"), chat_id)
+        return ChatConfig(**values)
+    except (TypeError, ValueError, AttributeError) as e:
+        logger.warning("Ignoring stored config for chat %s: %s", chat_id, e)
+        return ChatConfig()
+
+
+def _load_chat_config(chat_id: int) -> ChatConfig:
+    cfg = _evicted_configs.pop(chat_id, None)
+    if cfg is not None:
+        _dirty_configs.add(chat_id)
+        return cfg
+    cfg = _flushing.get(chat_id)
+    if cfg is not None:
+        return cfg
+    if _read_db is None:
+        return ChatConfig()
+    try:
+        row = _read_db.execute(
+            "SELECT data FROM chat_configs WHERE chat_id = ?", (chat_id,)
+        ).fetchone()
+    except sqlite3.Error as e:
+        logger.warning("Failed to load config for chat %s: %s", chat_id, e)
+        return ChatConfig()
+    return ChatConfig() if row is None else _config_from_json(chat_id, row[0])
+
+
+def _evict_chat_config() -> None:
+    chat_id, cfg = chat_configs.popitem(last=False)
+    if chat_id in _dirty_configs:
+        # Hold on to it until the next flush has written it
+        _dirty_configs.discard(chat_id)
+        _evicted_configs[chat_id] = cfg
+
+
+def _write_rows(config_rows: List[Tuple[int, str]], chat_rows: List[Tuple[int, str, str]]) -> None:
+    with _db_lock, _db:  # one transaction per batch
+        if config_rows:
+            _db.executemany(
+                "INSERT INTO chat_configs (chat_id, data) VALUES (?, ?) "
+                "ON CONFLICT(chat_id) DO UPDATE SET data = excluded.data",
+                config_rows,
+            )
+        if chat_rows:
+            _db.executemany(
+                "INSERT INTO known_chats (chat_id, title, type) VALUES (?, ?, ?) "
+                "ON CONFLICT(chat_id) DO UPDATE SET title = excluded.title, type = excluded.type",
+                chat_rows,
+            )
+
+
+async def flush_state() -> None:
+    if _db is None or not (_dirty_configs or _dirty_known_chats or _evicted_configs):
+        return
+
+    # Serialize on the event loop so no handler mutates a config mid-dump
+    pending = {cid: chat_configs[cid] for cid in _dirty_configs if cid in chat_configs}
+    pending.update(_evicted_configs)
+    dirty_chats = list(_dirty_known_chats)
+    _dirty_configs.clear()
+    _dirty_known_chats.clear()
+    _evicted_configs.clear()
+
+    config_rows = [(cid, _config_to_json(cfg)) for cid, cfg in pending.items()]
+    chat_rows = [(cid, *known_chats[cid]) for cid in dirty_chats]
+    _flushing.update(pending)
+
     try:
-        title = chat.title or "(no title)"
-    except Exception:
-        title = "(no title)"
-    known_chats[chat.id] = {
-        "title": title,
-        "type": chat.type,
-    }
+        await asyncio.to_thread(_write_rows, config_rows, chat_rows)
+    except Exception as e:
+        logger.warning("Failed to write state to %s: %s", STATE_DB, e)
+        _dirty_known_chats.update(dirty_chats)
+        for cid, cfg in pending.items():
+            current = chat_configs.get(cid)
+            if current is cfg:
+                _dirty_configs.add(cid)
+            elif current is None:
+                _evicted_configs.setdefault(cid, cfg)
+    finally:
+        for cid, cfg in pending.items():
+            if _flushing.get(cid) is cfg:
+                del _flushing[cid]
+
+
+async def _periodic_flush() -> None:
+    while True:
+        await asyncio.sleep(STATE_FLUSH_SECONDS)
+        await flush_state()
+
+
+# ---------------- Banned words ----------------
+
+def _build_banned_matcher(words: List[str]) -> Callable[[str], Optional[str]]:
+    """Compile banned words into a matcher that returns the first banned word found in a text."""
+    by_lower = {word.lower(): word for word in words if word}
+    if not by_lower:
+        return lambda text: None
+
+    if hyperscan is not None:
+        needles = list(by_lower)
+        db = hyperscan.Database()
+        db.compile(
+            expressions=[re.escape(needle).encode() for needle in needles],
+            ids=list(range(len(needles))),
+            flags=[hyperscan.HS_FLAG_UTF8 | hyperscan.HS_FLAG_SINGLEMATCH] * len(needles),
+        )
+
+        def match(text: str) -> Optional[str]:
+            hits: List[int] = []
+
+            def on_match(pattern_id, start, end, flags, context):
+                hits.append(pattern_id)
+                return True  # first hit is enough; stop scanning
+
+            try:
+                db.scan(text.lower().encode(), match_event_handler=on_match)
+            except hyperscan.ScanTerminated:
+                pass
+            return by_lower[needles[hits[0]]] if hits else None
+
+        return match
+
+    if ahocorasick is not None:
+        automaton = ahocorasick.Automaton()
+        for needle, word in by_lower.items():
+            automaton.add_word(needle, word)
+        automaton.make_automaton()
+
+        def match(text: str) -> Optional[str]:
+            for _, word in automaton.iter(text.lower()):
+                return word
+            return None
+
+        return match
+
+    # Stdlib fallback: one alternation, case-folded inside the regex engine
+    pattern = re.compile("|".join(map(re.escape, by_lower)), re.IGNORECASE)
+
+    def match(text: str) -> Optional[str]:
+        m = pattern.search(text)
+        if m is None:
+            return None
+        hit = m.group(0)
+        return by_lower.get(hit.lower(), hit)
+
+    return match
+
+
+def find_banned_word(cfg: ChatConfig, text: str) -> Optional[str]:
+    if cfg._banned_matcher is None:
+        cfg._banned_matcher = _build_banned_matcher(cfg.banned_words)
+    return cfg._banned_matcher(text)
+
+
+def remember_chat(chat) -> None:
+    title = getattr(chat, "title", None) or "(no title)"
+    # Runs for every moderated message; only write when something changed
+    info = known_chats.get(chat.id)
+    if info is None or info.title != title or info.type != chat.type:
+        known_chats[chat.id] = ChatInfo(title, chat.type)
+        _dirty_known_chats.add(chat.id)
+
+
+def invalidate_admin_cache(chat_id: int) -> None:
+    """Drop cached admin info for a chat (call when its admin list changes)."""
+    _admin_cache.pop(chat_id, None)
+    _bot_admin_cache.pop(chat_id, None)
+
+
+def _admin_cache_put(cache: dict, chat_id: int, value) -> None:
+    # dicts keep insertion order, so the first key is the oldest entry
+    cache.pop(chat_id, None)
+    if len(cache) >= ADMIN_CACHE_MAX_CHATS:
+        cache.pop(next(iter(cache)))
+    cache[chat_id] = (time.monotonic(), value)
+
+
+async def get_chat_admin_ids(chat_id: int, context: ContextTypes.DEFAULT_TYPE) -> FrozenSet[int]:
+    """Return admin user ids for a chat, served from a short-lived cache."""
+    cached = _admin_cache.get(chat_id)
+    if cached is not None and time.monotonic() - cached[0] < ADMIN_CACHE_TTL:
+        return cached[1]
+
+    admins = await context.bot.get_chat_administrators(chat_id)
+    admin_ids = frozenset(a.user.id for a in admins)
+    _admin_cache_put(_admin_cache, chat_id, admin_ids)
+    return admin_ids
+
+
+_TYPE_LABELS = {"group": "group", "supergroup": "group", "channel": "channel"}
 
 
 def chat_type_label(chat) -> str:
-    if chat.type in ("group", "supergroup"):
-        return "group"
-    if chat.type == "channel":
-        return "channel"
-    return "chat"
+    return _TYPE_LABELS.get(chat.type, "chat")
 
 
 async def is_user_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     """Check if user is global admin or chat admin."""
     user = update.effective_user
     chat = update.effective_chat
-    owner_id = get_admin_id()
 
     if user is None or chat is None:
         return False
 
     # Global owner/admin
-    if owner_id and user.id == owner_id:
+    if ADMIN_ID and user.id == ADMIN_ID:
         return True
 
     # In private chat, only global admin is considered admin
@@ -154,99 +566,232 @@ async def is_user_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> b
         return False
 
     try:
-        admins = await context.bot.get_chat_administrators(chat.id)
+        admin_ids = await get_chat_admin_ids(chat.id, context)
     except Exception as e:
         logger.warning("Failed to get chat admins for %s: %s", chat.id, e)
         return False
 
-    return any(a.user.id == user.id for a in admins)
+    return user.id in admin_ids
+
+
+def admin_only(fn):
+    """Run a command handler only for chat admins (and the global owner)."""
+
+    @functools.wraps(fn)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        if not await is_user_admin(update, context):
+            await update.message.reply_text("❌ This menu is for chat admins only.")
+            return
+        return await fn(update, context)
+
+    return wrapper
 
 
 async def is_bot_admin(chat_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
     """Check if OmniGate has admin rights in this chat."""
-    me = await context.bot.get_me()
+    cached = _bot_admin_cache.get(chat_id)
+    if cached is not None and time.monotonic() - cached[0] < ADMIN_CACHE_TTL:
+        return cached[1]
+
     try:
-        member = await context.bot.get_chat_member(chat_id, me.id)
+        # bot.id comes from the getMe done at startup, no extra request
+        member = await context.bot.get_chat_member(chat_id, context.bot.id)
     except Exception as e:
         logger.warning("Failed to get bot member info in chat %s: %s", chat_id, e)
         return False
 
-    return member.status in ("administrator", "creator")
+    is_admin = member.status in ADMIN_STATUSES
+    _admin_cache_put(_bot_admin_cache, chat_id, is_admin)
+    return is_admin
 
 
-async def audit_log(context: ContextTypes.DEFAULT_TYPE, text: str) -> None:
-    owner_id = get_admin_id()
-    if not owner_id:
-        return
+# Strong references to fire-and-forget tasks so they are not garbage collected mid-flight
+_background_tasks: Set[asyncio.Task] = set()
+
+
+def spawn_background(coro: Awaitable) -> None:
+    """Run a coroutine without making the current handler wait for it."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def _safe_send_dm(context: ContextTypes.DEFAULT_TYPE, user_id: int, text: str) -> None:
     try:
-        await context.bot.send_message(
-            chat_id=owner_id, text=f"🛡 OmniGate Log\n\n{text}"
+        await context.bot.send_message(chat_id=user_id, text=text)
+    except Exception as e:
+        logger.warning("Could not send DM to user_id=%s: %s", user_id, e)
+
+
+async def _restrict_new_member(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int) -> None:
+    try:
+        await context.bot.restrict_chat_member(
+            chat_id=chat_id,
+            user_id=user_id,
+            permissions=_MUTED_PERMS,
         )
-    except Exception:
-        pass
+    except Exception as e:
+        logger.warning("Failed to restrict new member: %s", e)
+
+
+# Owner notifications are queued and sent as coalesced digests, so a join
+# raid or flood produces a few owner DMs instead of one per event.
+OWNER_DIGEST_DELAY = 2.0
+OWNER_DIGEST_MIN_BATCH = 5
+_OWNER_DIGEST_HEADER = "🛡 OmniGate Log\n\n"
+_OWNER_DIGEST_SEPARATOR = "\n──\n"
+_owner_queue: "asyncio.Queue[str]" = asyncio.Queue()
+
+
+def notify_owner(text: str, parse_mode: Optional[str] = None) -> None:
+    """Queue an HTML or plain-text notice for the global owner (no-op without ADMIN_ID)."""
+    if not ADMIN_ID:
+        return
+    # Digests are sent as HTML; plain-text notices are escaped to render unchanged
+    _owner_queue.put_nowait(text if parse_mode == "HTML" else html.escape(text))
+
+
+def schedule_audit_log(text: str) -> None:
+    # Audit entries embed mention_html() links
+    notify_owner(text, parse_mode="HTML")
+
+
+def _drain_owner_queue(batch: List[str]) -> None:
+    while True:
+        try:
+            batch.append(_owner_queue.get_nowait())
+        except asyncio.QueueEmpty:
+            return
+
+
+def _split_owner_digest(batch: List[str]) -> List[str]:
+    """Join queued notices into messages that fit Telegram's text length limit."""
+    limit = MessageLimit.MAX_TEXT_LENGTH - len(_OWNER_DIGEST_HEADER)
+    chunks: List[str] = []
+    current = ""
+    for entry in batch:
+        entry = entry[:limit]
+        candidate = f"{current}{_OWNER_DIGEST_SEPARATOR}{entry}" if current else entry
+        if len(candidate) > limit:
+            chunks.append(current)
+            candidate = entry
+        current = candidate
+    if current:
+        chunks.append(current)
+    return [_OWNER_DIGEST_HEADER + chunk for chunk in chunks]
+
+
+async def _send_owner_digest(bot, batch: List[str]) -> None:
+    for text in _split_owner_digest(batch):
+        try:
+            await bot.send_message(chat_id=ADMIN_ID, text=text, parse_mode="HTML")
+        except BadRequest as e:
+            # e.g. a chat title that breaks the HTML markup; deliver it unformatted
+            logger.warning("Owner digest rejected as HTML (%s), resending as plain text", e)
+            try:
+                await bot.send_message(chat_id=ADMIN_ID, text=text)
+            except Exception as e2:
+                logger.warning("Failed to notify owner: %s", e2)
+        except Exception as e:
+            logger.warning("Failed to notify owner: %s", e)
+
+
+# Notices taken off the queue but not yet sent; post_stop flushes what's left
+_owner_batch: List[str] = []
+
+
+async def _owner_digest_loop(bot) -> None:
+    while True:
+        _owner_batch.append(await _owner_queue.get())
+        _drain_owner_queue(_owner_batch)
+        if len(_owner_batch) < OWNER_DIGEST_MIN_BATCH:
+            # Give a burst a moment to accumulate before sending
+            await asyncio.sleep(OWNER_DIGEST_DELAY)
+            _drain_owner_queue(_owner_batch)
+        await _send_owner_digest(bot, _owner_batch)
+        _owner_batch.clear()
 
 
 # ---------------- Command Handlers ----------------
 
+# Static reply texts are built once at import; only per-chat values are formatted in.
+_START_PRIVATE_TEXT = (
+    "👋 Hello! I am *OmniGate Bot*.\n\n"
+    "I manage join requests, filter spam, and keep your groups and channels clean.\n\n"
+    "To use me:\n"
+    "1️⃣ Add me to your group or channel\n"
+    "2️⃣ Promote me as admin (manage members + delete messages)\n"
+    "3️⃣ Inside that group/channel, send `/settings` to open the control panel.\n\n"
+    "You can also use `/mychats` here to see where we are both admins."
+)
+_START_OWNER_SUFFIX = (
+    "\n\nYou are registered as the global owner. "
+    "You will receive audit logs and error reports."
+)
+_START_GROUP_TEXT = (
+    "✅ OmniGate is active in this chat.\n\n"
+    "Only admins can configure me.\n"
+    "Send /settings to open the control panel."
+)
+
+_HELP_TEMPLATE = (
+    "🤖 *OmniGate Help* ({scope})\n\n"
+    "Core commands:\n"
+    "• `/settings` – open the admin control panel\n"
+    "• `/status` – show join stats for this chat\n"
+    "• `/mychats` – (in DM) list chats where you and I are admins\n"
+)
+_HELP_PRIVATE_TEXT = _HELP_TEMPLATE.format(scope="in your groups/channels")
+_HELP_CHAT_TEXTS = {
+    label: _HELP_TEMPLATE.format(scope=f"in this {label}")
+    for label in ("group", "channel", "chat")
+}
+
+_STATUS_TEMPLATE = (
+    "📊 *Status for this {label}*\n\n"
+    "Mode: `{mode}`\n"
+    "Approved today: `{approved_today}`\n"
+    "Declined today: `{declined_today}`\n"
+    "Approved total: `{approved_total}`\n"
+    "Declined total: `{declined_total}`\n"
+)
+
+
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     chat = update.effective_chat
-    owner_id = get_admin_id()
 
     if chat.type == "private":
-        text = (
-            "👋 Hello! I am *OmniGate Bot*.\n\n"
-            "I manage join requests, filter spam, and keep your groups and channels clean.\n\n"
-            "To use me:\n"
-            "1️⃣ Add me to your group or channel\n"
-            "2️⃣ Promote me as admin (manage members + delete messages)\n"
-            "3️⃣ Inside that group/channel, send `/settings` to open the control panel.\n\n"
-            "You can also use `/mychats` here to see where we are both admins."
-        )
-        if owner_id and user and user.id == owner_id:
-            text += (
-                "\n\nYou are registered as the global owner. "
-                "You will receive audit logs and error reports."
-            )
+        text = _START_PRIVATE_TEXT
+        if ADMIN_ID and user and user.id == ADMIN_ID:
+            text += _START_OWNER_SUFFIX
         await update.message.reply_markdown(text)
     else:
         remember_chat(chat)
-        await update.message.reply_text(
-            "✅ OmniGate is active in this chat.\n\n"
-            "Only admins can configure me.\n"
-            "Send /settings to open the control panel."
-        )
+        await update.message.reply_text(_START_GROUP_TEXT)
 
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat = update.effective_chat
     if chat.type == "private":
-        scope = "in your groups/channels"
+        text = _HELP_PRIVATE_TEXT
     else:
-        scope = f"in this {chat_type_label(chat)}"
-
-    text = (
-        f"🤖 *OmniGate Help* ({scope})\n\n"
-        "Core commands:\n"
-        "• `/settings` – open the admin control panel\n"
-        "• `/status` – show join stats for this chat\n"
-        "• `/mychats` – (in DM) list chats where you and I are admins\n"
-    )
+        text = _HELP_CHAT_TEXTS[chat_type_label(chat)]
     await update.message.reply_markdown(text)
 
 
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat = update.effective_chat
     remember_chat(chat)
-    cfg = get_chat_config(chat.id)
-
-    text = (
-        f"📊 *Status for this {chat_type_label(chat)}*\n\n"
-        f"Mode: `{cfg.mode}`\n"
-        f"Approved today: `{cfg.approved_today}`\n"
-        f"Declined today: `{cfg.declined_today}`\n"
-        f"Approved total: `{cfg.approved_total}`\n"
-        f"Declined total: `{cfg.declined_total}`\n"
+    cfg = get_chat_config(chat.id, chat)
+
+    text = _STATUS_TEMPLATE.format(
+        label=cfg.type_label,
+        mode=cfg.mode,
+        approved_today=cfg.approved_today,
+        declined_today=cfg.declined_today,
+        approved_total=cfg.approved_total,
+        declined_total=cfg.declined_total,
     )
     await update.message.reply_markdown(text)
 
@@ -278,15 +823,13 @@ async def mychats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         except Exception:
             continue
 
-        if member.status not in ("administrator", "creator"):
+        if member.status not in ADMIN_STATUSES:
             continue
 
-        title = info.get("title", "(no title)")
-        ctype = info.get("type", "group")
-        if ctype in ("group", "supergroup"):
-            groups.append(title)
-        elif ctype == "channel":
-            channels.append(title)
+        if info.type in GROUP_CHAT_TYPES:
+            groups.append(info.title)
+        elif info.type == "channel":
+            channels.append(info.title)
 
     if not groups and not channels:
         await update.message.reply_text(
@@ -314,28 +857,55 @@ async def mychats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 # ---------------- Settings Panel (Inline Buttons) ----------------
 
 def build_settings_keyboard(cfg: ChatConfig) -> InlineKeyboardMarkup:
+    return _build_settings_keyboard_cached(
+        cfg.mode,
+        cfg.require_username,
+        cfg.block_bots,
+        cfg.block_links,
+        cfg.clean_service_messages,
+        cfg.warnings_enabled,
+        cfg.flood_enabled,
+        cfg.safe_welcome_enabled,
+        cfg.strict_mode_enabled,
+    )
+
+
+# The keyboard depends only on these flags (3 modes x 2^8 toggles), and PTB
+# markup objects are immutable, so one instance per combination is reused.
+@functools.lru_cache(maxsize=256)
+def _build_settings_keyboard_cached(
+    mode: str,
+    require_username: bool,
+    block_bots: bool,
+    block_links: bool,
+    clean_service_messages: bool,
+    warnings_enabled: bool,
+    flood_enabled: bool,
+    safe_welcome_enabled: bool,
+    strict_mode_enabled: bool,
+) -> InlineKeyboardMarkup:
     def on_off(value: bool) -> str:
         return "ON ✅" if value else "OFF ❌"
 
     buttons = [
         [
-            InlineKeyboardButton(f"Mode: {cfg.mode}", callback_data="cfg:mode"),
+            InlineKeyboardButton(f"Mode: {mode}", callback_data="cfg:mode"),
         ],
         [
-            InlineKeyboardButton(f"Require username: {on_off(cfg.require_username)}", callback_data="cfg:req_user"),
-            InlineKeyboardButton(f"Block bots: {on_off(cfg.block_bots)}", callback_data="cfg:block_bots"),
+            InlineKeyboardButton(f"Require username: {on_off(require_username)}", callback_data="cfg:req_user"),
+            InlineKeyboardButton(f"Block bots: {on_off(block_bots)}", callback_data="cfg:block_bots"),
         ],
         [
-            InlineKeyboardButton(f"Block links: {on_off(cfg.block_links)}", callback_data="cfg:block_links"),
-            InlineKeyboardButton(f"Clean service: {on_off(cfg.clean_service_messages)}", callback_data="cfg:clean_svc"),
+            InlineKeyboardButton(f"Block links: {on_off(block_links)}", callback_data="cfg:block_links"),
+            InlineKeyboardButton(f"Clean service: {on_off(clean_service_messages)}", callback_data="cfg:clean_svc"),
         ],
         [
-            InlineKeyboardButton(f"Warnings: {on_off(cfg.warnings_enabled)}", callback_data="cfg:warnings"),
-            InlineKeyboardButton(f"Flood: {on_off(cfg.flood_enabled)}", callback_data="cfg:flood"),
+            InlineKeyboardButton(f"Warnings: {on_off(warnings_enabled)}", callback_data="cfg:warnings"),
+            InlineKeyboardButton(f"Flood: {on_off(flood_enabled)}", callback_data="cfg:flood"),
         ],
         [
-            InlineKeyboardButton(f"Safe welcome: {on_off(cfg.safe_welcome_enabled)}", callback_data="cfg:safe_welcome"),
-            InlineKeyboardButton(f"Strict mode: {on_off(cfg.strict_mode_enabled)}", callback_data="cfg:strict"),
+            InlineKeyboardButton(f"Safe welcome: {on_off(safe_welcome_enabled)}", callback_data="cfg:safe_welcome"),
+            InlineKeyboardButton(f"Strict mode: {on_off(strict_mode_enabled)}", callback_data="cfg:strict"),
         ],
         [
             InlineKeyboardButton("Banned words 📜", callback_data="cfg:banned_words"),
@@ -345,27 +915,47 @@ def build_settings_keyboard(cfg: ChatConfig) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(buttons)
 
 
+_SETTINGS_TEMPLATE = (
+    "⚙️ *OmniGate Settings – {title}*\n\n"
+    "Mode: `{mode}`\n"
+    "Require username: `{require_username}`\n"
+    "Block bots: `{block_bots}`\n"
+    "Block links: `{block_links}`\n"
+    "Clean service messages: `{clean_service}`\n"
+    "Warnings: `{warnings}` (limit: `{warnings_limit}`, action: `{warnings_action}`)\n"
+    "Flood: `{flood}` (max `{flood_max}` / `{flood_window}`s)\n"
+    "Safe welcome: `{safe_welcome}`\n"
+    "Strict mode: `{strict}`\n"
+    "Custom welcome: `{custom_welcome}`\n"
+    "Banned words: `{banned_count}` entries\n"
+    "\nTap the buttons below to toggle options."
+)
+_ON_OFF = ("OFF", "ON")
+
+
 def settings_summary_text(chat, cfg: ChatConfig) -> str:
-    return (
-        f"⚙️ *OmniGate Settings – {chat.title or 'this chat'}*\n\n"
-        f"Mode: `{cfg.mode}`\n"
-        f"Require username: `{'ON' if cfg.require_username else 'OFF'}`\n"
-        f"Block bots: `{'ON' if cfg.block_bots else 'OFF'}`\n"
-        f"Block links: `{'ON' if cfg.block_links else 'OFF'}`\n"
-        f"Clean service messages: `{'ON' if cfg.clean_service_messages else 'OFF'}`\n"
-        f"Warnings: `{'ON' if cfg.warnings_enabled else 'OFF'}` (limit: `{cfg.warnings_limit}`, action: `{cfg.warnings_action}`)\n"
-        f"Flood: `{'ON' if cfg.flood_enabled else 'OFF'}` (max `{cfg.flood_max_msgs}` / `{cfg.flood_window_seconds}`s)\n"
-        f"Safe welcome: `{'ON' if cfg.safe_welcome_enabled else 'OFF'}`\n"
-        f"Strict mode: `{'ON' if cfg.strict_mode_enabled else 'OFF'}`\n"
-        f"Custom welcome: `{'YES' if cfg.welcome_message else 'NO'}`\n"
-        f"Banned words: `{len(cfg.banned_words)}` entries\n"
-        "\nTap the buttons below to toggle options."
+    return _SETTINGS_TEMPLATE.format(
+        title=chat.title or "this chat",
+        mode=cfg.mode,
+        require_username=_ON_OFF[bool(cfg.require_username)],
+        block_bots=_ON_OFF[bool(cfg.block_bots)],
+        block_links=_ON_OFF[bool(cfg.block_links)],
+        clean_service=_ON_OFF[bool(cfg.clean_service_messages)],
+        warnings=_ON_OFF[bool(cfg.warnings_enabled)],
+        warnings_limit=cfg.warnings_limit,
+        warnings_action=cfg.warnings_action,
+        flood=_ON_OFF[bool(cfg.flood_enabled)],
+        flood_max=cfg.flood_max_msgs,
+        flood_window=cfg.flood_window_seconds,
+        safe_welcome=_ON_OFF[bool(cfg.safe_welcome_enabled)],
+        strict=_ON_OFF[bool(cfg.strict_mode_enabled)],
+        custom_welcome="YES" if cfg.welcome_message else "NO",
+        banned_count=len(cfg.banned_words),
     )
 
 
 async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat = update.effective_chat
-    user = update.effective_user
 
     if chat.type == "private":
         await update.message.reply_text(
@@ -374,10 +964,13 @@ async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         return
 
     remember_chat(chat)
+    await _open_settings_panel(update, context)
 
-    if not await is_user_admin(update, context):
-        await update.message.reply_text("❌ This menu is for chat admins only.")
-        return
+
+@admin_only
+async def _open_settings_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat = update.effective_chat
+    user = update.effective_user
 
     if not await is_bot_admin(chat.id, context):
         await update.message.reply_text(
@@ -391,12 +984,24 @@ async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     keyboard = build_settings_keyboard(cfg)
 
     await update.message.reply_markdown(text, reply_markup=keyboard)
-    await audit_log(
-        context,
-        f"Admin {user.mention_html()} opened settings in {chat.title} ({chat.id}).",
+    schedule_audit_log(
+        f"Admin {user.mention_html()} opened settings in {html.escape(chat.title or '')} ({chat.id}).",
     )
 
 
+# Settings buttons that flip a boolean ChatConfig field: callback_data -> attribute
+_SETTING_TOGGLES = {
+    "cfg:req_user": "require_username",
+    "cfg:block_bots": "block_bots",
+    "cfg:block_links": "block_links",
+    "cfg:clean_svc": "clean_service_messages",
+    "cfg:warnings": "warnings_enabled",
+    "cfg:flood": "flood_enabled",
+    "cfg:safe_welcome": "safe_welcome_enabled",
+    "cfg:strict": "strict_mode_enabled",
+}
+
+
 async def settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
@@ -412,44 +1017,14 @@ async def settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     cfg = get_chat_config(chat.id)
     changed = False
-    info_msg = ""
 
-    if data == "cfg:mode":
-        cfg.mode = {"AUTO": "FILTERED", "FILTERED": "OFF", "OFF": "AUTO"}[cfg.mode]
-        changed = True
-        info_msg = f"Mode changed to {cfg.mode}."
-    elif data == "cfg:req_user":
-        cfg.require_username = not cfg.require_username
-        changed = True
-        info_msg = f"Require username set to {cfg.require_username}."
-    elif data == "cfg:block_bots":
-        cfg.block_bots = not cfg.block_bots
-        changed = True
-        info_msg = f"Block bots set to {cfg.block_bots}."
-    elif data == "cfg:block_links":
-        cfg.block_links = not cfg.block_links
-        changed = True
-        info_msg = f"Block links set to {cfg.block_links}."
-    elif data == "cfg:clean_svc":
-        cfg.clean_service_messages = not cfg.clean_service_messages
-        changed = True
-        info_msg = f"Clean service messages set to {cfg.clean_service_messages}."
-    elif data == "cfg:warnings":
-        cfg.warnings_enabled = not cfg.warnings_enabled
-        changed = True
-        info_msg = f"Warnings enabled set to {cfg.warnings_enabled}."
-    elif data == "cfg:flood":
-        cfg.flood_enabled = not cfg.flood_enabled
+    toggle_attr = _SETTING_TOGGLES.get(data)
+    if toggle_attr is not None:
+        setattr(cfg, toggle_attr, not getattr(cfg, toggle_attr))
         changed = True
-        info_msg = f"Flood control enabled set to {cfg.flood_enabled}."
-    elif data == "cfg:safe_welcome":
-        cfg.safe_welcome_enabled = not cfg.safe_welcome_enabled
+    elif data == "cfg:mode":
+        cfg.mode = _NEXT_MODE[cfg.mode]
         changed = True
-        info_msg = f"Safe welcome set to {cfg.safe_welcome_enabled}."
-    elif data == "cfg:strict":
-        cfg.strict_mode_enabled = not cfg.strict_mode_enabled
-        changed = True
-        info_msg = f"Strict mode set to {cfg.strict_mode_enabled}."
     elif data == "cfg:banned_words":
         # Simple info for now; advanced UI could be added later
         if cfg.banned_words:
@@ -473,6 +1048,7 @@ async def settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
 
     if changed:
+        mark_state_dirty(chat.id)
         text = settings_summary_text(chat, cfg)
         keyboard = build_settings_keyboard(cfg)
         try:
@@ -484,194 +1060,220 @@ async def settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
         except Exception as e:
             logger.warning("Failed to edit settings message: %s", e)
 
-        await audit_log(
-            context,
-            f"Admin {user.mention_html()} changed setting '{data}' in {chat.title} ({chat.id}).",
+        schedule_audit_log(
+            f"Admin {user.mention_html()} changed setting '{html.escape(data)}' "
+            f"in {html.escape(chat.title or '')} ({chat.id}).",
         )
 
 
 # ---------------- Join Handling ----------------
 
-async def handle_join_request(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    join_request: ChatJoinRequest = update.chat_join_request
-    chat = join_request.chat
-    user = join_request.from_user
-    cfg = get_chat_config(chat.id)
-    remember_chat(chat)
-    owner_id = get_admin_id()
-
-    logger.info(
-        "Join request: chat_id=%s chat_title=%s chat_type=%s user_id=%s username=%s is_bot=%s",
-        chat.id,
-        chat.title,
-        chat.type,
-        user.id,
-        user.username,
-        user.is_bot,
-    )
+# Owner notification templates (filled with %-formatting)
+_PENDING_MSG = (
+    "ℹ️ Join request pending in %s (%s).\n"
+    "Mode is OFF, so I am not auto-approving."
+)
+_DECLINE_MSG = (
+    "❌ Declined join request in %s (%s).\n"
+    "User: %s (%s)\n"
+    "Reason: %s"
+)
+_JOIN_ERROR_MSG = (
+    "⚠️ Error while processing join request in %s (%s).\n"
+    "User: %s (%s)\n"
+    "Error: %s"
+)
 
-    # OFF mode: leave pending
-    if cfg.mode == "OFF":
-        logger.info("Mode OFF for chat_id=%s, leaving join request pending.", chat.id)
-        if owner_id:
-            try:
-                await context.bot.send_message(
-                    chat_id=owner_id,
-                    text=(
-                        f"ℹ️ Join request pending in {chat.title} ({chat.id}).\n"
-                        f"Mode is OFF, so I am not auto-approving."
-                    ),
-                )
-            except Exception:
-                pass
-        return
 
-    allowed = True
+def _evaluate_filters(cfg: ChatConfig, user) -> Tuple[bool, Tuple[str, ...]]:
+    """Apply FILTERED / strict-mode join rules; returns (allowed, reasons)."""
     reasons = []
 
     # Basic filters for FILTERED mode (and optionally strict_mode)
     if cfg.mode == "FILTERED" or cfg.strict_mode_enabled:
         if cfg.block_bots and user.is_bot:
-            allowed = False
             reasons.append("User is a bot.")
 
         if cfg.require_username and not user.username:
-            allowed = False
             reasons.append("Missing username.")
 
         if cfg.min_username_length > 0 and user.username:
             if len(user.username) < cfg.min_username_length:
-                allowed = False
                 reasons.append(
                     f"Username too short (< {cfg.min_username_length})."
                 )
 
     # In AUTO mode, we can still optionally block bots if strict_mode_enabled
     if cfg.mode == "AUTO" and cfg.strict_mode_enabled and user.is_bot:
-        allowed = False
         reasons.append("User is a bot (strict mode).")
 
-    try:
-        if allowed:
-            await context.bot.approve_chat_join_request(chat_id=chat.id, user_id=user.id)
-            cfg.approved_total += 1
-            cfg.approved_today += 1
-            logger.info("Approved join request user_id=%s chat_id=%s", user.id, chat.id)
-
-            # Safe welcome: restrict until verify
-            if cfg.safe_welcome_enabled and chat.type in ("group", "supergroup"):
-                try:
-                    await context.bot.restrict_chat_member(
-                        chat_id=chat.id,
-                        user_id=user.id,
-                        permissions=ChatPermissions(
-                            can_send_messages=False,
-                            can_send_media_messages=False,
-                            can_send_other_messages=False,
-                            can_add_web_page_previews=False,
-                        ),
-                    )
-                except Exception as e:
-                    logger.warning("Failed to restrict new member: %s", e)
-
-                pending_verification[(chat.id, user.id)] = True
-
-                # Send verification button in group
-                keyboard = InlineKeyboardMarkup(
-                    [
-                        [
-                            InlineKeyboardButton(
-                                "✅ I am human", callback_data=f"verify:{chat.id}:{user.id}"
-                            )
-                        ]
-                    ]
-                )
-                try:
-                    await context.bot.send_message(
-                        chat_id=chat.id,
-                        text=(
-                            f"Welcome {user.mention_html()}!\n\n"
-                            "Please tap the button below within a few minutes to verify you are human. "
-                            "Until then, your permissions are limited."
-                        ),
-                        reply_markup=keyboard,
-                        parse_mode="HTML",
-                    )
-                except Exception as e:
-                    logger.warning("Failed to send verification message: %s", e)
-            else:
-                # Normal welcome DM
-                chat_label = chat.title or "this chat"
-                if chat.type in ("group", "supergroup"):
-                    type_label = "group"
-                elif chat.type == "channel":
-                    type_label = "channel"
-                else:
-                    type_label = "chat"
-
-                if cfg.welcome_message:
-                    welcome_text = cfg.welcome_message
-                else:
-                    welcome_text = (
-                        f"✅ You have been approved to join {chat_label}.\n\n"
-                        f"This {type_label} uses OmniGate to manage join requests.\n"
-                        "Please read the rules and respect other members."
-                    )
-                try:
-                    await context.bot.send_message(chat_id=user.id, text=welcome_text)
-                except Exception as e:
-                    logger.warning(
-                        "Could not send DM to user_id=%s: %s", user.id, e
-                    )
+    return not reasons, tuple(reasons)
 
-        else:
-            await context.bot.decline_chat_join_request(chat_id=chat.id, user_id=user.id)
-            cfg.declined_total += 1
-            cfg.declined_today += 1
-            logger.info("Declined join request user_id=%s chat_id=%s", user.id, chat.id)
-
-            if owner_id:
-                reason_text = "; ".join(reasons) if reasons else "Filtered by rules."
-                try:
-                    await context.bot.send_message(
-                        chat_id=owner_id,
-                        text=(
-                            f"❌ Declined join request in {chat.title} ({chat.id}).\n"
-                            f"User: {user.mention_html()} ({user.id})\n"
-                            f"Reason: {reason_text}"
-                        ),
-                        parse_mode="HTML",
+
+async def _approve_join(context: ContextTypes.DEFAULT_TYPE, chat, user, cfg: ChatConfig) -> None:
+    await context.bot.approve_chat_join_request(chat_id=chat.id, user_id=user.id)
+    cfg.approved_total += 1
+    cfg.approved_today += 1
+    mark_state_dirty(chat.id)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Approved join request user_id=%s chat_id=%s", user.id, chat.id)
+
+    # Safe welcome: restrict until verify
+    if cfg.safe_welcome_enabled and chat.type in GROUP_CHAT_TYPES:
+        pending_verification[(chat.id, user.id)] = True
+        _schedule_verification_timeout(context, chat.id, user.id)
+
+        # Send verification button in group
+        keyboard = InlineKeyboardMarkup(
+            [
+                [
+                    InlineKeyboardButton(
+                        "✅ I am human", callback_data=f"verify:{chat.id}:{user.id}"
                     )
-                except Exception as e:
-                    logger.warning("Failed to notify owner about decline: %s", e)
+                ]
+            ]
+        )
+        # The restriction and the prompt are independent calls; send them together
+        _, prompt_result = await asyncio.gather(
+            _restrict_new_member(context, chat.id, user.id),
+            context.bot.send_message(
+                chat_id=chat.id,
+                text=(
+                    f"Welcome {user.mention_html()}!\n\n"
+                    "Please tap the button below within a few minutes to verify you are human. "
+                    "Until then, your permissions are limited."
+                ),
+                reply_markup=keyboard,
+                parse_mode="HTML",
+            ),
+            return_exceptions=True,
+        )
+        if isinstance(prompt_result, Exception):
+            logger.warning("Failed to send verification message: %s", prompt_result)
+    else:
+        # Normal welcome DM
+        chat_label = chat.title or "this chat"
+        if cfg.welcome_message:
+            welcome_text = cfg.welcome_message
+        else:
+            welcome_text = (
+                f"✅ You have been approved to join {chat_label}.\n\n"
+                f"This {cfg.type_label} uses OmniGate to manage join requests.\n"
+                "Please read the rules and respect other members."
+            )
+        spawn_background(_safe_send_dm(context, user.id, welcome_text))
+
+
+async def _decline_join(
+    context: ContextTypes.DEFAULT_TYPE, chat, user, cfg: ChatConfig, reasons: Tuple[str, ...]
+) -> None:
+    await context.bot.decline_chat_join_request(chat_id=chat.id, user_id=user.id)
+    cfg.declined_total += 1
+    cfg.declined_today += 1
+    mark_state_dirty(chat.id)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Declined join request user_id=%s chat_id=%s", user.id, chat.id)
+
+    reason_text = "; ".join(reasons) if reasons else "Filtered by rules."
+    notify_owner(
+        _DECLINE_MSG
+        % (html.escape(chat.title or ""), chat.id, user.mention_html(), user.id, html.escape(reason_text)),
+        parse_mode="HTML",
+    )
+
 
+async def handle_join_request(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    join_request: ChatJoinRequest = update.chat_join_request
+    chat = join_request.chat
+    user = join_request.from_user
+    cfg = get_chat_config(chat.id, chat)
+    remember_chat(chat)
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "Join request: chat_id=%s chat_title=%s chat_type=%s user_id=%s username=%s is_bot=%s",
+            chat.id,
+            chat.title,
+            chat.type,
+            user.id,
+            user.username,
+            user.is_bot,
+        )
+
+    # OFF mode: leave pending
+    if cfg.mode == "OFF":
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Mode OFF for chat_id=%s, leaving join request pending.", chat.id)
+        notify_owner(_PENDING_MSG % (chat.title, chat.id))
+        return
+
+    try:
+        # AUTO without strict mode never filters, so skip the rule evaluation entirely
+        if cfg.mode == "AUTO" and not cfg.strict_mode_enabled:
+            await _approve_join(context, chat, user, cfg)
+        else:
+            allowed, reasons = _evaluate_filters(cfg, user)
+            if allowed:
+                await _approve_join(context, chat, user, cfg)
+            else:
+                await _decline_join(context, chat, user, cfg, reasons)
     except Exception as e:
-        logger.error("Error handling join request: %s", e, exc_info=True)
-        if owner_id:
-            try:
-                await context.bot.send_message(
-                    chat_id=owner_id,
-                    text=(
-                        f"⚠️ Error while processing join request in {chat.title} ({chat.id}).\n"
-                        f"User: {user.mention_html()} ({user.id})\n"
-                        f"Error: {e}"
-                    ),
-                    parse_mode="HTML",
-                )
-            except Exception:
-                pass
+        # Full tracebacks only at DEBUG; formatting them is costly during API outages
+        logger.error("Error handling join request: %s: %s", type(e).__name__, e)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Join request traceback:", exc_info=True)
+        notify_owner(
+            _JOIN_ERROR_MSG
+            % (html.escape(chat.title or ""), chat.id, user.mention_html(), user.id, html.escape(str(e))),
+            parse_mode="HTML",
+        )
 
 
-async def verify_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    query = update.callback_query
-    data = query.data
-    await query.answer()
+def _schedule_verification_timeout(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int) -> None:
+    key = (chat_id, user_id)
+    previous = _verification_timers.pop(key, None)
+    if previous is not None:
+        previous.cancel()
+    _verification_timers[key] = asyncio.get_running_loop().call_later(
+        VERIFY_TIMEOUT_SECONDS,
+        lambda: spawn_background(_expire_verification(context, chat_id, user_id)),
+    )
+
 
-    if not data.startswith("verify:"):
+async def _expire_verification(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int) -> None:
+    """Remove a member who never pressed the safe-welcome button."""
+    key = (chat_id, user_id)
+    _verification_timers.pop(key, None)
+    if pending_verification.pop(key, None) is None:
         return
 
-    parts = data.split(":")
-    if len(parts) != 3:
+    try:
+        # ban + unban = kick; they can request to join again later
+        await context.bot.ban_chat_member(chat_id, user_id)
+        await context.bot.unban_chat_member(chat_id, user_id, only_if_banned=True)
+        logger.info("Removed unverified member user_id=%s chat_id=%s", user_id, chat_id)
+    except Exception as e:
+        logger.warning("Failed to remove unverified member: %s", e)
+
+
+async def _lift_verification_mute(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int) -> None:
+    try:
+        await context.bot.restrict_chat_member(
+            chat_id=chat_id,
+            user_id=user_id,
+            permissions=_UNMUTED_PERMS,
+        )
+    except Exception as e:
+        logger.warning("Failed to unrestrict verified member: %s", e)
+
+
+async def verify_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    # Telegram accepts one answer per callback query, so every path below
+    # answers exactly once (a second answer would be rejected and its text lost).
+    parts = query.data.split(":")
+    if len(parts) != 3 or not parts[1].lstrip("-").isdigit() or not parts[2].isdigit():
+        await query.answer()
         return
 
     chat_id = int(parts[1])
@@ -687,25 +1289,16 @@ async def verify_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await query.answer("You are already verified or no longer pending.")
         return
 
-    cfg = get_chat_config(chat_id)
-
-    # Remove restriction
-    try:
-        await context.bot.restrict_chat_member(
-            chat_id=chat_id,
-            user_id=user_id,
-            permissions=ChatPermissions(
-                can_send_messages=True,
-                can_send_media_messages=True,
-                can_send_other_messages=True,
-                can_add_web_page_previews=True,
-            ),
-        )
-    except Exception as e:
-        logger.warning("Failed to unrestrict verified member: %s", e)
-
+    # Claim the verification before awaiting so a double tap can't run it twice
     pending_verification.pop(key, None)
+    timer = _verification_timers.pop(key, None)
+    if timer is not None:
+        timer.cancel()
 
+    await asyncio.gather(
+        query.answer("✅ Verified"),
+        _lift_verification_mute(context, chat_id, user_id),
+    )
     await query.edit_message_text(
         f"✅ Thank you, {user.mention_html()}. You are now verified and can participate.",
         parse_mode="HTML",
@@ -714,72 +1307,100 @@ async def verify_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 # ---------------- Moderation: links, banned words, warnings, flood ----------------
 
+_LINK_RE = re.compile(r"https?://|www\.|t\.me/", re.IGNORECASE)
+_URL_ENTITY_TYPES = frozenset({MessageEntity.URL, MessageEntity.TEXT_LINK})
+
+
 async def moderation_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     message = update.effective_message
     chat = update.effective_chat
     user = update.effective_user
 
-    if not message or not message.text or not user or chat.type not in ("group", "supergroup"):
+    if not message or not message.text or not user or chat.type not in GROUP_CHAT_TYPES:
         return
 
     remember_chat(chat)
     cfg = get_chat_config(chat.id)
-    text_lower = message.text.lower()
+    # Most chats enable none of these; bail out before touching the message
+    if not (cfg.flood_enabled or cfg.block_links or cfg.banned_words):
+        return
+
     user_key = (chat.id, user.id)
+    text = message.text
 
-    # Flood control
-    if cfg.flood_enabled:
-        now = time.time()
-        bucket = flood_activity.setdefault(user_key, [])
+    # Flood control (edits aren't new messages)
+    if cfg.flood_enabled and update.edited_message is None:
+        now = time.monotonic()
+        flood_max = cfg.flood_max_msgs
+        window = cfg.flood_window_seconds
+        bucket = flood_activity.get(user_key)
+        if bucket is None or bucket.maxlen != flood_max + 1:
+            bucket = deque(maxlen=flood_max + 1)
+        # re-store on every message to keep an active sender's bucket alive
+        flood_activity[user_key] = bucket
         bucket.append(now)
         # keep only recent
-        window = cfg.flood_window_seconds
-        bucket[:] = [t for t in bucket if now - t <= window]
-        if len(bucket) > cfg.flood_max_msgs:
+        while now - bucket[0] > window:
+            bucket.popleft()
+        if len(bucket) > flood_max:
             # Too many messages
-            try:
-                await message.delete()
-            except Exception as e:
-                logger.warning("Failed to delete flood message: %s", e)
-            if cfg.warnings_enabled:
-                await apply_warning(chat, user, context, reason="Flood / spam")
+            await _enforce(message, chat, user, context, cfg, "flood", "Flood / spam")
             return
 
     # Block links
     if cfg.block_links:
-        has_url = False
-        if message.entities:
-            for e in message.entities:
-                if e.type in ("url", "text_link"):
-                    has_url = True
-                    break
-        if any(x in text_lower for x in ("http://", "https://", "www.", "t.me/")):
-            has_url = True
-
+        has_url = _LINK_RE.search(text) is not None or any(
+            e.type in _URL_ENTITY_TYPES for e in message.entities
+        )
         if has_url:
-            try:
-                await message.delete()
-            except Exception as e:
-                logger.warning("Failed to delete link message: %s", e)
-            if cfg.warnings_enabled:
-                await apply_warning(chat, user, context, reason="Links are not allowed")
+            await _enforce(message, chat, user, context, cfg, "link", "Links are not allowed")
             return
 
     # Banned words
     if cfg.banned_words:
-        for bad in cfg.banned_words:
-            if bad and bad.lower() in text_lower:
-                try:
-                    await message.delete()
-                except Exception as e:
-                    logger.warning("Failed to delete banned word message: %s", e)
-                if cfg.warnings_enabled:
-                    await apply_warning(chat, user, context, reason=f"Banned word: {bad}")
-                return
-
-
-async def apply_warning(chat, user, context: ContextTypes.DEFAULT_TYPE, reason: str) -> None:
-    cfg = get_chat_config(chat.id)
+        bad = find_banned_word(cfg, text)
+        if bad is not None:
+            await _enforce(message, chat, user, context, cfg, "banned word", f"Banned word: {bad}")
+            return
+
+
+async def _enforce(message, chat, user, context, cfg: ChatConfig, kind: str, reason: str) -> None:
+    """Delete an offending message and warn its sender."""
+    # Deletes never wait on the (rate-limited) warning sends of earlier messages
+    try:
+        await message.delete()
+    except Exception as e:
+        logger.warning("Failed to delete %s message: %s", kind, e)
+    if not cfg.warnings_enabled:
+        return
+
+    # Updates are processed concurrently; serialize warnings per chat so they
+    # (and the mute/kick at the limit) go out in the order the messages came in.
+    lock = context.chat_data.get("moderation_lock")
+    if lock is None:
+        lock = context.chat_data["moderation_lock"] = asyncio.Lock()
+    async with lock:
+        await apply_warning(chat, user, context, reason=reason, cfg=cfg)
+
+
+_WARN_LIMIT_MSG = (
+    "🚫 Warnings limit reached in %s (%s).\n"
+    "User: %s (%s)\n"
+    "Action: %s\n"
+    "Reason: %s"
+)
+
+
+async def apply_warning(
+    chat,
+    user,
+    context: ContextTypes.DEFAULT_TYPE,
+    reason: str,
+    cfg: Optional[ChatConfig] = None,
+) -> None:
+    if cfg is None:
+        cfg = get_chat_config(chat.id)
+    limit = cfg.warnings_limit
     key = (chat.id, user.id)
     count = user_warnings.get(key, 0) + 1
     user_warnings[key] = count
@@ -788,7 +1409,7 @@ async def apply_warning(chat, user, context: ContextTypes.DEFAULT_TYPE, reason:
         await context.bot.send_message(
             chat_id=chat.id,
             text=(
-                f"⚠️ Warning {count}/{cfg.warnings_limit} for {user.mention_html()}.\n"
+                f"⚠️ Warning {count}/{limit} for {user.mention_html()}.\n"
                 f"Reason: {reason}"
             ),
             parse_mode="HTML",
@@ -796,25 +1417,21 @@ async def apply_warning(chat, user, context: ContextTypes.DEFAULT_TYPE, reason:
     except Exception as e:
         logger.warning("Failed to send warning message: %s", e)
 
-    if count >= cfg.warnings_limit:
+    if count >= limit:
         # Take action
         if cfg.warnings_action == "mute":
-            until = int(time.time() + cfg.warnings_mute_minutes * 60)
+            mute_minutes = cfg.warnings_mute_minutes
+            until = int(time.time()) + mute_minutes * 60
             try:
                 await context.bot.restrict_chat_member(
                     chat_id=chat.id,
                     user_id=user.id,
-                    permissions=ChatPermissions(
-                        can_send_messages=False,
-                        can_send_media_messages=False,
-                        can_send_other_messages=False,
-                        can_add_web_page_previews=False,
-                    ),
+                    permissions=_MUTED_PERMS,
                     until_date=until,
                 )
             except Exception as e:
                 logger.warning("Failed to mute user after warnings: %s", e)
-            action_text = f"User muted for {cfg.warnings_mute_minutes} minutes."
+            action_text = f"User muted for {mute_minutes} minutes."
         else:
             try:
                 await context.bot.ban_chat_member(chat.id, user.id)
@@ -822,21 +1439,18 @@ async def apply_warning(chat, user, context: ContextTypes.DEFAULT_TYPE, reason:
                 logger.warning("Failed to kick user after warnings: %s", e)
             action_text = "User kicked from the group."
 
-        owner_id = get_admin_id()
-        if owner_id:
-            try:
-                await context.bot.send_message(
-                    chat_id=owner_id,
-                    text=(
-                        f"🚫 Warnings limit reached in {chat.title} ({chat.id}).\n"
-                        f"User: {user.mention_html()} ({user.id})\n"
-                        f"Action: {action_text}\n"
-                        f"Reason: {reason}"
-                    ),
-                    parse_mode="HTML",
-                )
-            except Exception:
-                pass
+        notify_owner(
+            _WARN_LIMIT_MSG
+            % (
+                html.escape(chat.title or ""),
+                chat.id,
+                user.mention_html(),
+                user.id,
+                action_text,
+                html.escape(reason),
+            ),
+            parse_mode="HTML",
+        )
 
 
 # ---------------- Clean service messages ----------------
@@ -845,60 +1459,298 @@ async def service_message_handler(update: Update, context: ContextTypes.DEFAULT_
     message = update.effective_message
     chat = update.effective_chat
 
-    if not message or chat.type not in ("group", "supergroup"):
+    if not message or chat.type not in GROUP_CHAT_TYPES:
         return
 
     cfg = get_chat_config(chat.id)
     if not cfg.clean_service_messages:
         return
 
-    # These are status updates like join/leave/pin, etc.
+    # Join/leave/pin status updates (see SERVICE_GROUP_FILTER)
     try:
         await message.delete()
     except Exception as e:
         logger.warning("Failed to delete service message: %s", e)
 
 
+# ---------------- Member status changes ----------------
+
+async def chat_member_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Drop cached admin info when someone (or the bot) is promoted or demoted."""
+    member_update = update.chat_member or update.my_chat_member
+    old_admin = member_update.old_chat_member.status in ADMIN_STATUSES
+    new_admin = member_update.new_chat_member.status in ADMIN_STATUSES
+    if old_admin or new_admin:
+        invalidate_admin_cache(member_update.chat.id)
+
+
 # ---------------- Main ----------------
 
+# Recently processed update ids; redelivered updates (e.g. after a dropped
+# connection) must not double-count approvals or re-run moderation.
+SEEN_UPDATES_MAX = 10_000
+_seen_update_ids: Set[int] = set()
+_seen_update_order: deque = deque(maxlen=SEEN_UPDATES_MAX)
+
+
+async def drop_duplicate_updates(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    update_id = update.update_id
+    if update_id in _seen_update_ids:
+        logger.debug("Dropping duplicate update %s", update_id)
+        raise ApplicationHandlerStop
+    if len(_seen_update_order) == SEEN_UPDATES_MAX:
+        _seen_update_ids.discard(_seen_update_order[0])
+    _seen_update_order.append(update_id)
+    _seen_update_ids.add(update_id)
+
+
+# Command name -> handler, dispatched from a single MessageHandler
+COMMANDS = {
+    "start": start_command,
+    "help": help_command,
+    "status": status_command,
+    "mychats": mychats_command,
+    "settings": settings_command,
+}
+
+
+async def command_dispatcher(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Route /command[@botname] messages through the COMMANDS table."""
+    words = update.message.text.split()
+    name, _, target = words[0][1:].partition("@")
+    if target and target.lower() != (context.bot.username or "").lower():
+        return  # addressed to another bot in the group
+
+    handler = COMMANDS.get(name.lower())
+    if handler is None:
+        return
+    context.args = words[1:]
+    await handler(update, context)
+
+
+# Callback data prefix (before the first ':') -> handler
+CALLBACKS = {
+    "cfg": settings_callback,
+    "verify": verify_callback,
+}
+
+
+async def callback_dispatcher(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Route inline button presses through the CALLBACKS table."""
+    query = update.callback_query
+    handler = CALLBACKS.get((query.data or "").partition(":")[0])
+    if handler is None:
+        await query.answer()  # stale or foreign button; stop the client spinner
+        return
+    await handler(update, context)
+
+
+# Message filters, combined once at import
+TEXT_GROUP_FILTER = filters.TEXT & ~filters.COMMAND & filters.ChatType.GROUPS
+# Only the service messages worth cleaning up: joins, leaves and pins
+SERVICE_GROUP_FILTER = (
+    filters.StatusUpdate.NEW_CHAT_MEMBERS
+    | filters.StatusUpdate.LEFT_CHAT_MEMBER
+    | filters.StatusUpdate.PINNED_MESSAGE
+) & filters.ChatType.GROUPS
+
+
+# Only the update types the registered handlers consume. Service messages
+# (joins, pins, ...) arrive as regular message updates; edits go through
+# moderation too, so a link can't be edited into a clean message.
+# chat_member updates are only sent to bots that are admins in the chat.
+ALLOWED_UPDATES = [
+    Update.MESSAGE,
+    Update.EDITED_MESSAGE,
+    Update.CALLBACK_QUERY,
+    Update.CHAT_JOIN_REQUEST,
+    Update.CHAT_MEMBER,
+    Update.MY_CHAT_MEMBER,
+]
+
+# Update types each handler class consumes, to catch a handler that
+# ALLOWED_UPDATES would starve
+_HANDLER_UPDATE_TYPES = {
+    MessageHandler: (Update.MESSAGE, Update.EDITED_MESSAGE),
+    CallbackQueryHandler: (Update.CALLBACK_QUERY,),
+    ChatJoinRequestHandler: (Update.CHAT_JOIN_REQUEST,),
+    ChatMemberHandler: (Update.CHAT_MEMBER, Update.MY_CHAT_MEMBER),
+}
+
+
+def _check_allowed_updates(app) -> None:
+    for group_handlers in app.handlers.values():
+        for handler in group_handlers:
+            missing = [
+                t for t in _HANDLER_UPDATE_TYPES.get(type(handler), ()) if t not in ALLOWED_UPDATES
+            ]
+            if missing:
+                logger.warning(
+                    "%s for %s won't receive %s updates (not in ALLOWED_UPDATES)",
+                    type(handler).__name__, handler.callback.__name__, ", ".join(missing),
+                )
+
+
+# Handler groups, built once at import. Handlers in a group are tried in
+# order until one matches, so the most frequent updates (plain group
+# messages) come first; their filters are disjoint, so the order doesn't
+# change which handler runs.
+HANDLERS = {
+    # Runs before every other handler group
+    -100: [TypeHandler(Update, drop_duplicate_updates)],
+    0: [
+        # Moderation for regular text messages
+        MessageHandler(TEXT_GROUP_FILTER, moderation_message_handler),
+        # Commands (single handler, dict dispatch)
+        MessageHandler(filters.COMMAND & filters.UpdateType.MESSAGE, command_dispatcher),
+        # Settings callbacks + verification button (single handler, dict dispatch)
+        CallbackQueryHandler(callback_dispatcher),
+        # Join requests
+        ChatJoinRequestHandler(handle_join_request),
+        # Service messages (join/leave/pin)
+        MessageHandler(SERVICE_GROUP_FILTER, service_message_handler),
+        # Promotions/demotions keep the admin caches honest
+        ChatMemberHandler(chat_member_handler, ChatMemberHandler.ANY_CHAT_MEMBER),
+    ],
+}
+
+
+class SendRateLimiter(AIORateLimiter):
+    """AIORateLimiter that only shapes message sends.
+
+    PTB applies the limits to every call carrying a chat_id, which would also
+    throttle join approvals, deletions and restrictions during a raid or a
+    flood. Other calls skip the limiters but still retry on RetryAfter.
+    """
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if not endpoint.startswith("send"):
+            data = {}  # only consulted to pick the limiters, not sent
+        return await super().process_request(
+            callback, args, kwargs, endpoint, data, rate_limit_args
+        )
+
+
+_flush_task: Optional[asyncio.Task] = None
+_digest_task: Optional[asyncio.Task] = None
+
+
+async def post_init(app) -> None:
+    global _flush_task, _digest_task
+    _flush_task = asyncio.create_task(_periodic_flush())
+    _digest_task = asyncio.create_task(_owner_digest_loop(app.bot))
+
+
+async def post_stop(app) -> None:
+    # The bot is still usable here; send whatever notices are left
+    if _digest_task is not None:
+        _digest_task.cancel()
+        await asyncio.gather(_digest_task, return_exceptions=True)
+    _drain_owner_queue(_owner_batch)
+    if _owner_batch:
+        await _send_owner_digest(app.bot, _owner_batch)
+        _owner_batch.clear()
+
+
+async def post_shutdown(app) -> None:
+    if _flush_task is not None:
+        _flush_task.cancel()
+    await flush_state()
+    close_state_db()
+
+
 def main() -> None:
     if not BOT_TOKEN:
         raise RuntimeError("BOT_TOKEN environment variable is missing.")
 
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
-
-    # Commands
-    app.add_handler(CommandHandler("start", start_command))
-    app.add_handler(CommandHandler("help", help_command))
-    app.add_handler(CommandHandler("status", status_command))
-    app.add_handler(CommandHandler("mychats", mychats_command))
-    app.add_handler(CommandHandler("settings", settings_command))
+    open_state_db()
+
+    if uvloop is not None:
+        # PTB creates its loop from the policy when run_polling/run_webhook starts
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    # Shapes outgoing sends to Telegram's flood limits (30/s overall, 20/min
+    # per group) and retries any call rejected with RetryAfter after the
+    # advertised delay. A 429 pauses every call, so stay under the group cap.
+    rate_limiter = SendRateLimiter(
+        overall_max_rate=30,
+        overall_time_period=1,
+        group_max_rate=20,
+        group_time_period=60,
+        max_retries=3,
+    )
 
-    # Settings callbacks + verification button
-    app.add_handler(CallbackQueryHandler(settings_callback, pattern=r"^cfg:"))
-    app.add_handler(CallbackQueryHandler(verify_callback, pattern=r"^verify:"))
+    # One multiplexed HTTP/2 connection pool for all outgoing API calls, sized
+    # to match concurrent_updates so handlers don't queue for a connection.
+    # A self-hosted Bot API server only speaks HTTP/1.1.
+    request = HTTPXRequest(
+        connection_pool_size=256,
+        http_version="1.1" if BOT_API_URL else "2",
+        read_timeout=20,
+        write_timeout=20,
+        pool_timeout=5,
+    )
 
-    # Join requests
-    app.add_handler(ChatJoinRequestHandler(handle_join_request))
+    # Long polling gets its own connection so a pending getUpdates never holds
+    # a slot in the pool above. PTB adds the poll timeout (30s) on top of
+    # read_timeout; each poll returns up to 100 updates (Telegram's maximum,
+    # the default limit).
+    get_updates_request = HTTPXRequest(
+        connection_pool_size=1,
+        http_version="1.1" if BOT_API_URL else "2",
+        read_timeout=15,
+    )
 
-    # Moderation for regular text messages
-    app.add_handler(
-        MessageHandler(
-            filters.TEXT & ~filters.COMMAND & (filters.ChatType.GROUPS),
-            moderation_message_handler,
+    builder = ApplicationBuilder().token(BOT_TOKEN)
+    if BOT_API_URL:
+        builder = (
+            builder.base_url(f"{BOT_API_URL}/bot")
+            .base_file_url(f"{BOT_API_URL}/file/bot")
+            .local_mode(True)
         )
+
+    app = (
+        builder
+        .request(request)
+        .get_updates_request(get_updates_request)
+        .rate_limiter(rate_limiter)
+        # Handle updates from different chats in parallel so one slow API call
+        # (e.g. a verification DM) doesn't stall everyone else
+        .concurrent_updates(256)
+        # Verification timeouts use loop.call_later; no scheduler thread needed
+        .job_queue(None)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
     )
 
-    # Service messages (join/leave/pin/etc.)
-    app.add_handler(
-        MessageHandler(
-            filters.StatusUpdate.ALL & (filters.ChatType.GROUPS),
-            service_message_handler,
+    app.add_handlers(HANDLERS)
+
+    _check_allowed_updates(app)
+
+    if WEBHOOK_URL and not FORCE_POLLING:
+        logger.info("OmniGate starting with webhook on port %s...", PORT)
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            # Serve the same path Telegram posts to, e.g. https://host/<secret-path>
+            url_path=urlsplit(WEBHOOK_URL).path.lstrip("/"),
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=ALLOWED_UPDATES,
+            max_connections=100,
         )
-    )
+        return
 
     logger.info("OmniGate starting with long polling...")
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Pending updates are deliberately kept: dropping them would strand join
+    # requests that arrived while the bot was down.
+    app.run_polling(
+        allowed_updates=ALLOWED_UPDATES,
+        poll_interval=0.0,
+        timeout=30,
+    )
 
 
 if __name__ == "__main__":
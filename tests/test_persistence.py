@@ -0,0 +1,84 @@
+import asyncio
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import main
+
+
+class WriteBehindTest(unittest.TestCase):
+    """Lazy loads racing the write-behind flush must never see a stale row."""
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        patches = [
+            mock.patch.object(main, "STATE_DB", os.path.join(tmpdir.name, "state.db")),
+            mock.patch.object(main, "MAX_CHAT_CONFIGS", 1),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        for state in (main.chat_configs, main.known_chats, main._dirty_configs,
+                      main._dirty_known_chats, main._evicted_configs, main._flushing):
+            state.clear()
+        main.open_state_db()
+        self.addCleanup(main.close_state_db)
+
+    def _evict_with_changes(self, chat_id):
+        cfg = main.get_chat_config(chat_id)
+        cfg.mode = "OFF"
+        cfg.approved_total = 5
+        main.mark_state_dirty(chat_id)
+        main.get_chat_config(chat_id - 1)  # pushes chat_id out of the LRU
+        self.assertNotIn(chat_id, main.chat_configs)
+
+    def _reload(self, chat_id):
+        main.chat_configs.clear()
+        return main.get_chat_config(chat_id)
+
+    def test_load_during_flush_sees_flushed_config(self):
+        self._evict_with_changes(-100)
+        writing = threading.Event()
+        release = threading.Event()
+        write_rows = main._write_rows
+
+        def slow_write(*args):
+            writing.set()
+            release.wait(5)
+            write_rows(*args)
+
+        async def scenario():
+            with mock.patch.object(main, "_write_rows", slow_write):
+                flush = asyncio.create_task(main.flush_state())
+                await asyncio.to_thread(writing.wait, 5)
+                cfg = main.get_chat_config(-100)
+                release.set()
+                await flush
+            return cfg
+
+        cfg = asyncio.run(scenario())
+        self.assertEqual((cfg.mode, cfg.approved_total), ("OFF", 5))
+
+        cfg.approved_total += 1
+        main.mark_state_dirty(-100)
+        asyncio.run(main.flush_state())
+        cfg = self._reload(-100)
+        self.assertEqual((cfg.mode, cfg.approved_total), ("OFF", 6))
+
+    def test_failed_flush_keeps_changes_for_the_next_one(self):
+        self._evict_with_changes(-100)
+
+        with mock.patch.object(main, "_write_rows", side_effect=OSError("disk full")):
+            asyncio.run(main.flush_state())
+        self.assertFalse(main._flushing)
+
+        asyncio.run(main.flush_state())
+        cfg = self._reload(-100)
+        self.assertEqual((cfg.mode, cfg.approved_total), ("OFF", 5))
+
+
+if __name__ == "__main__":
+    unittest.main()